@@ -1,5 +1,30 @@
 #!/bin/python
 
+import gzip
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import botocore
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+RUN_METRICS_KEY = "UpdateMembers"
+RUN_METRICS_RETENTION = 90 * 24 * 60 * 60
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException")
+SNAPSHOT_MANIFEST = "_MANIFEST.json"
+SNAPSHOT_RUN = "_SNAPSHOT.json.gz"
+SNAPSHOT_SUFFIX = ".json.gz"
+# Must match the format written by UpdateMember
+SNAPSHOT_VERSION = 2
+SNAPSHOT_COLUMNS = ("account", "standard", "controlId", "controlArn", "status", "disabledReason", "exceptionSource")
+SNAPSHOT_WORKERS = 16
+DELETE_BATCH_SIZE = 1000
+dynamodb_client = None
+s3_client = None
+
 
 def lambda_handler(event, context):
     result = {}
@@ -9,7 +34,146 @@ def lambda_handler(event, context):
             failed = True
             result[execution["account"]] = execution["error"]
 
+    # Only full updates are representative for the concurrency tuning
+    if "tuning" in event and event.get("mode", "update") == "update":
+        global dynamodb_client
+        if not dynamodb_client:
+            dynamodb_client = boto3.client("dynamodb")
+        run_metrics = get_run_metrics(event["processedItems"], event["tuning"])
+        logger.info("Run metrics: %s", str(run_metrics))
+        save_run_metrics(run_metrics, dynamodb_client, os.environ["RunMetrics"])
+
+    # Merge the control state snapshots of this run and mark the run as complete
+    if "run" in event:
+        global s3_client
+        if not s3_client:
+            s3_client = boto3.client("s3")
+        complete_snapshot(event["processedItems"], event["run"], s3_client, os.environ["ControlSnapshots"])
+
     if failed:
         return {"statusCode": 500, "failed_accounts": result}
 
     return {"statusCode": 200}
+
+
+def get_run_metrics(processed_items, tuning):
+    """
+    Aggregate the metrics reported by the UpdateMember executions of this run
+    """
+    measured = [execution["metrics"] for execution in processed_items if "metrics" in execution]
+    run_metrics = {
+        "Concurrency": tuning["concurrency"],
+        "Accounts": len(measured),
+        "Failures": 0,
+        "Throttled": 0,
+        "Duration": 0,
+        "Calls": sum(metrics["calls"] for metrics in measured),
+        "Retries": sum(metrics["retries"] for metrics in measured),
+        "ThrottleWait": sum(metrics.get("throttleWait", 0) for metrics in measured),
+    }
+    if measured:
+        run_metrics["Duration"] = sum(metrics["duration"] for metrics in measured) / len(measured)
+
+    for execution in processed_items:
+        if execution["statusCode"] == 500:
+            run_metrics["Failures"] += 1
+            if any(error in execution["error"] for error in THROTTLING_ERRORS):
+                run_metrics["Throttled"] += 1
+    return run_metrics
+
+
+def save_run_metrics(run_metrics, client, table_name):
+    """
+    Persist run metrics so that following executions can tune their concurrency
+    """
+    timestamp = int(time.time())
+    item = {
+        "Metric": {"S": RUN_METRICS_KEY},
+        "Timestamp": {"N": str(timestamp)},
+        "ExpiresAt": {"N": str(timestamp + RUN_METRICS_RETENTION)},
+    }
+    for key, value in run_metrics.items():
+        item[key] = {"N": str(value)}
+    client.put_item(TableName=table_name, Item=item)
+
+
+def complete_snapshot(processed_items, run, client, bucket):
+    """
+    Merge the account snapshots of the run into a single run snapshot, write the manifest and delete the account
+    snapshots. Snapshots are only used for reporting, so failures are logged and leave the run incomplete.
+    """
+    try:
+        keys = list_account_snapshots(run, client, bucket)
+        client.put_object(
+            Bucket=bucket,
+            Key=run + "/" + SNAPSHOT_RUN,
+            Body=merge_snapshots(keys, client, bucket),
+        )
+        store_snapshot_manifest(processed_items, run, client, bucket)
+    except botocore.exceptions.ClientError as error:
+        logger.error("Snapshot of run %s could not be completed: %s", run, error)
+        return
+    try:
+        delete_account_snapshots(keys, client, bucket)
+    except botocore.exceptions.ClientError as error:
+        # Left over account snapshots expire with the bucket lifecycle
+        logger.warning("Account snapshots of run %s could not be deleted: %s", run, error)
+
+
+def list_account_snapshots(run, client, bucket):
+    """ return keys of the account snapshots of the run """
+    keys = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=run + "/"):
+        keys += [
+            content["Key"]
+            for content in page.get("Contents", [])
+            if content["Key"].endswith(SNAPSHOT_SUFFIX) and not content["Key"].split("/")[-1].startswith("_")
+        ]
+    return sorted(keys)
+
+
+def merge_snapshots(keys, client, bucket):
+    """
+    Read the account snapshots in parallel and merge them into a single gzip compressed columnar snapshot
+    """
+
+    def read_columns(key):
+        data = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return json.loads(gzip.decompress(data).decode("utf-8"))
+
+    columns = {column: [] for column in SNAPSHOT_COLUMNS}
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as executor:
+        for key, snapshot in zip(keys, executor.map(read_columns, keys)):
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                logger.warning("Skip snapshot %s with unsupported version %s", key, str(snapshot.get("version")))
+                continue
+            for column in SNAPSHOT_COLUMNS:
+                columns[column] += snapshot["columns"][column]
+    data = json.dumps({"version": SNAPSHOT_VERSION, "columns": columns}, separators=(",", ":"))
+    return gzip.compress(data.encode("utf-8"))
+
+
+def delete_account_snapshots(keys, client, bucket):
+    """ delete the account snapshots merged into the run snapshot """
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + DELETE_BATCH_SIZE]], "Quiet": True},
+        )
+
+
+def store_snapshot_manifest(processed_items, run, client, bucket):
+    """
+    Write the manifest listing processed and failed accounts of the run. Reports only read runs with a manifest.
+    """
+    manifest = {
+        "run": run,
+        "processed": sorted(execution["account"] for execution in processed_items if execution["statusCode"] != 500),
+        "failed": sorted(execution["account"] for execution in processed_items if execution["statusCode"] == 500),
+    }
+    client.put_object(
+        Bucket=bucket,
+        Key=run + "/" + SNAPSHOT_MANIFEST,
+        Body=json.dumps(manifest).encode("utf-8"),
+    )
@@ -1,20 +1,42 @@
 #!/bin/python
 
 import logging
+import math
 import os
 import boto3
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 DISABLED_REASON = "Exception"
+EXCEPTIONS_SCHEMA_V2 = "v2"
+MODE_UPDATE = "update"
+MODES = (MODE_UPDATE, "plan", "apply")
+RUN_METRICS_KEY = "UpdateMembers"
+HISTORY_LENGTH = 10
+RUN_METRICS_COUNTS = ("Timestamp", "Concurrency", "Accounts", "Failures", "Throttled", "Calls", "Retries")
+RUN_METRICS_TIMES = ("Duration", "ThrottleWait")
+DEFAULT_CONCURRENCY = 3
+MIN_CONCURRENCY = 1
+THROTTLE_THRESHOLD = 0.05
+THROTTLE_WAIT_THRESHOLD = 0.1
 securityhub_client = None
 organizations_client = None
 dynamodb_client = None
+stepfunctions_client = None
+
+
+class InvalidInputError(Exception):
+    """ Error Class for invalid state machine input """
+
+    pass
 
 
 def lambda_handler(event, context):
 
     # print(event)
+    # Reject invalid input before any member account is touched
+    mode, plan = get_mode(event["input"])
+
     # get a list of all member accounts
 
     # Optimization - no need to reinitilize the  security hub client for every instance of this Lambda function
@@ -38,16 +60,54 @@ def lambda_handler(event, context):
     # when it was suspended without being removed from Security Hub administrator account.
     member_accounts = list(set(member_accounts).intersection(active_accounts))
 
-    response = dynamodb_client.scan(TableName=os.environ["DynamoDB"])
-    exceptions = convert_exceptions(response)
+    # With the v2 schema, each UpdateMember execution queries the exceptions of its own account
+    if os.environ.get("ExceptionsSchema") == EXCEPTIONS_SCHEMA_V2:
+        exceptions = dict()
+    else:
+        response = dynamodb_client.scan(TableName=os.environ["DynamoDB"])
+        exceptions = convert_exceptions(response)
+
+    # Choose the Map concurrency for this execution based on previous and parallel runs
+    global stepfunctions_client
+    if not stepfunctions_client:
+        stepfunctions_client = boto3.client("stepfunctions")
+    running_executions = count_running_executions(stepfunctions_client, event["stateMachine"])
+    history = get_run_history(dynamodb_client, os.environ["RunMetrics"])
+    tuning = tune_concurrency(
+        history,
+        len(member_accounts),
+        float(os.environ["TargetApiRate"]),
+        float(os.environ["RunDeadline"]),
+        int(os.environ["MaxConcurrency"]),
+        running_executions,
+    )
+    logger.info("Concurrency tuning: %s", str(tuning))
 
     return {
         "statusCode": 200,
         "accounts": member_accounts,
         "exceptions": exceptions,
+        "tuning": tuning,
+        "mode": mode,
+        "plan": plan,
     }
 
 
+def get_mode(execution_input):
+    """
+    Validate mode and plan name of the state machine input. Return mode and plan name.
+    """
+    mode = execution_input.get("mode", MODE_UPDATE)
+    plan = execution_input.get("plan", "")
+    if mode not in MODES:
+        raise InvalidInputError(
+            "Unknown mode '" + str(mode) + "'. Valid modes: " + ", ".join(MODES)
+        )
+    if mode != MODE_UPDATE and (not isinstance(plan, str) or plan == ""):
+        raise InvalidInputError("Mode '" + mode + "' requires a plan name.")
+    return mode, plan
+
+
 def convert_exceptions(response):
     """
     Convert exceptions from DynamoDB into simpler dictionary format
@@ -134,3 +194,115 @@ def get_active_accounts(client):
             response = None
 
     return active_members
+
+
+def get_run_history(client, table_name):
+    """
+    Fetch the metrics of the most recent executions, newest first
+    """
+    response = client.query(
+        TableName=table_name,
+        KeyConditionExpression="Metric = :metric",
+        ExpressionAttributeValues={":metric": {"S": RUN_METRICS_KEY}},
+        ScanIndexForward=False,
+        Limit=HISTORY_LENGTH,
+    )
+    return convert_run_metrics(response)
+
+
+def convert_run_metrics(response):
+    """
+    Convert run metrics from DynamoDB into simpler dictionary format
+    """
+    history = []
+    for item in response["Items"]:
+        # Counts stay integers, e.g. the concurrency is passed on to the MaxConcurrency of the Map state
+        run = {key: int(float(item[key]["N"])) for key in RUN_METRICS_COUNTS if key in item}
+        run.update({key: float(item[key]["N"]) for key in RUN_METRICS_TIMES if key in item})
+        history.append(run)
+    return history
+
+
+def tune_concurrency(history, account_count, target_api_rate, deadline, max_concurrency, running_executions=1):
+    """
+    Choose the Map concurrency for the next execution from the run history (newest first).
+
+    The concurrency is the lowest value that processes all accounts within the deadline, capped by
+    the share of the target API rate left to this execution, by the throttling observed in the run
+    history and by max_concurrency.
+    """
+    tuning = {"concurrency": min(DEFAULT_CONCURRENCY, max_concurrency)}
+    runs = [run for run in history if run.get("Accounts", 0) > 0]
+    if not runs:
+        logger.info("No run history. Use default concurrency.")
+        return tuning
+
+    accounts = sum(run["Accounts"] for run in runs)
+    # Average time and number of API calls needed for a single account
+    duration = sum(run["Duration"] * run["Accounts"] for run in runs) / accounts
+    calls = sum(run["Calls"] for run in runs) / accounts
+    if duration <= 0 or calls <= 0:
+        return tuning
+
+    deadline_concurrency = math.ceil(account_count * duration / deadline)
+    # Parallel executions share the target API rate
+    rate_concurrency = math.floor(target_api_rate / max(1, running_executions) / (calls / duration))
+
+    throttled = [run["Concurrency"] for run in runs if is_throttled(run)]
+    latest = runs[0]
+    if is_throttled(latest):
+        # Back off multiplicatively if the latest run was throttled
+        feedback_concurrency = math.floor(latest["Concurrency"] / 2)
+    elif throttled:
+        # Increase in small steps, but stay below the lowest concurrency throttled within the history
+        feedback_concurrency = min(latest["Concurrency"] + 1, min(throttled) - 1)
+    else:
+        feedback_concurrency = max_concurrency
+
+    upper_bound = min(rate_concurrency, feedback_concurrency, max_concurrency)
+    if deadline_concurrency > upper_bound:
+        logger.warning(
+            "Concurrency of %d needed to meet the deadline exceeds the limit of %d.",
+            deadline_concurrency,
+            upper_bound,
+        )
+
+    tuning["concurrency"] = int(max(MIN_CONCURRENCY, min(deadline_concurrency, upper_bound)))
+    tuning["deadlineConcurrency"] = deadline_concurrency
+    tuning["rateConcurrency"] = rate_concurrency
+    tuning["feedbackConcurrency"] = feedback_concurrency
+    tuning["runningExecutions"] = running_executions
+    return tuning
+
+
+def is_throttled(run):
+    """
+    return True if more than THROTTLE_THRESHOLD of the API calls of a run were retried, any account failed due to throttling
+    or the accounts spent more than THROTTLE_WAIT_THRESHOLD of their duration waiting on the client side rate limiter.
+    The adaptive retry mode delays requests instead of retrying them, so retries alone understate throttling.
+    """
+    retry_rate = run.get("Retries", 0) / run["Calls"] if run.get("Calls") else 0
+    account_time = run.get("Duration", 0) * run.get("Accounts", 0)
+    wait_share = run.get("ThrottleWait", 0) / account_time if account_time else 0
+    return (
+        retry_rate > THROTTLE_THRESHOLD
+        or run.get("Throttled", 0) > 0
+        or wait_share > THROTTLE_WAIT_THRESHOLD
+    )
+
+
+def count_running_executions(client, state_machine_arn):
+    """
+    Use pagination to count running executions of the state machine, including the current one
+    """
+    response = client.list_executions(stateMachineArn=state_machine_arn, statusFilter="RUNNING")
+    running = 0
+    while response:
+        running += len(response["executions"])
+        if "nextToken" in response:
+            response = client.list_executions(
+                stateMachineArn=state_machine_arn, statusFilter="RUNNING", nextToken=response["nextToken"]
+            )
+        else:
+            response = None
+    return max(1, running)
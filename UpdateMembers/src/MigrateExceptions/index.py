@@ -0,0 +1,120 @@
+#!/bin/python
+
+import logging
+import os
+import time
+import boto3
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+BATCH_SIZE = 25
+MAX_RETRIES = 8
+RETRY_BASE_DELAY = 0.1
+dynamodb_client = None
+
+
+class MigrationError(Exception):
+    """ Error Class for items which could not be written to the v2 table """
+
+    pass
+
+
+def lambda_handler(event, context):
+
+    global dynamodb_client
+    if not dynamodb_client:
+        dynamodb_client = boto3.client("dynamodb")
+
+    migrated = migrate_exceptions(
+        dynamodb_client, os.environ["DynamoDB"], os.environ["DynamoDBV2"]
+    )
+
+    return {"statusCode": 200, "migrated": migrated}
+
+
+def migrate_exceptions(client, source_table, target_table):
+    """
+    Synchronize the v2 table (one item per control and account) with the v1 table (one item per control).
+    Items of the v2 table which no longer exist in the v1 table are deleted. Return number of written items.
+    """
+    items = []
+    for control in scan_table(client, source_table):
+        items += convert_exception(control)
+
+    keys = {(item["ControlId"]["S"], item["AccountId"]["S"]) for item in items}
+    stale_keys = [
+        {"ControlId": item["ControlId"], "AccountId": item["AccountId"]}
+        for item in scan_table(client, target_table)
+        if (item["ControlId"]["S"], item["AccountId"]["S"]) not in keys
+    ]
+
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    requests += [{"DeleteRequest": {"Key": key}} for key in stale_keys]
+    for i in range(0, len(requests), BATCH_SIZE):
+        write_batch(client, target_table, requests[i : i + BATCH_SIZE])
+    logger.info(
+        "Migrated %d exceptions to %s and deleted %d stale exceptions",
+        len(items),
+        target_table,
+        len(stale_keys),
+    )
+    return len(items)
+
+
+def scan_table(client, table_name):
+    """
+    Use pagination to fetch all items of a table
+    """
+    response = client.scan(TableName=table_name)
+    items = []
+    while response:
+        items += response["Items"]
+        if "LastEvaluatedKey" in response:
+            response = client.scan(
+                TableName=table_name, ExclusiveStartKey=response["LastEvaluatedKey"]
+            )
+        else:
+            response = None
+    return items
+
+
+def convert_exception(control):
+    """
+    Convert a v1 exception item into v2 items. An account listed as both disabled and enabled keeps both flags,
+    so the conflict is still detected by UpdateMember.
+    """
+    control_id = control["ControlId"]["S"]
+    disabled = [entry["S"] for entry in control.get("Disabled", {}).get("L", [])]
+    enabled = [entry["S"] for entry in control.get("Enabled", {}).get("L", [])]
+    disabled_reason = control.get("DisabledReason", {}).get("S", "")
+
+    items = []
+    for account_id in sorted(set(disabled + enabled)):
+        item = {
+            "ControlId": {"S": control_id},
+            "AccountId": {"S": account_id},
+            "Disabled": {"BOOL": account_id in disabled},
+            "Enabled": {"BOOL": account_id in enabled},
+        }
+        if disabled_reason != "":
+            item["DisabledReason"] = {"S": disabled_reason}
+        items.append(item)
+    return items
+
+
+def write_batch(client, table_name, requests):
+    """
+    Write up to 25 put/delete requests and retry unprocessed items with exponential backoff
+    """
+    request_items = {table_name: requests}
+    for attempt in range(MAX_RETRIES + 1):
+        response = client.batch_write_item(RequestItems=request_items)
+        request_items = response.get("UnprocessedItems", {})
+        if not request_items:
+            return
+        if attempt < MAX_RETRIES:
+            logger.info("Retry unprocessed items...")
+            time.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+    raise MigrationError(
+        "Items could not be written after " + str(MAX_RETRIES) + " retries: " + str(request_items)
+    )
@@ -0,0 +1,118 @@
+#!/bin/python
+"""
+Read the control state snapshots exported by the UpdateMember Lambda function without calling Security Hub.
+
+UpdateMember stores one <AccountId>.json.gz snapshot per account under the prefix <execution-start-time>/.
+When the run completed, CheckResult merges them into <execution-start-time>/_SNAPSHOT.json.gz and
+writes <execution-start-time>/_MANIFEST.json.
+"""
+
+import gzip
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+# Must match the format written by UpdateMember
+SNAPSHOT_VERSION = 2
+SNAPSHOT_COLUMNS = ("account", "standard", "controlId", "controlArn", "status", "disabledReason", "exceptionSource")
+RUN_SNAPSHOT = "_SNAPSHOT.json.gz"
+MANIFEST = "_MANIFEST.json"
+
+
+class SnapshotError(Exception):
+    """ Error Class for control state snapshots which cannot be read """
+
+    pass
+
+
+class S3SnapshotStore:
+    """ Snapshot storage in an S3 bucket """
+
+    def __init__(self, bucket, client):
+        self.bucket = bucket
+        self.client = client
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def exists(self, key):
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=key, MaxKeys=1)
+        return any(content["Key"] == key for content in response.get("Contents", []))
+
+    def list_runs(self):
+        runs = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Delimiter="/"):
+            runs += [prefix["Prefix"].rstrip("/") for prefix in page.get("CommonPrefixes", [])]
+        return sorted(runs)
+
+
+class LocalSnapshotStore:
+    """ Snapshot storage in a local directory, e.g. synchronized with 'aws s3 sync' """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read(self, key):
+        with open(os.path.join(self.directory, key), "rb") as snapshot_file:
+            return snapshot_file.read()
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.directory, key))
+
+    def list_runs(self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+
+def read_snapshot(data):
+    """
+    Deserialize columnar snapshot. Return dictionary of columns.
+    """
+    snapshot = json.loads(gzip.decompress(data).decode("utf-8"))
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError("Unsupported snapshot version: " + str(snapshot.get("version")))
+    return snapshot["columns"]
+
+
+def get_latest_run(store):
+    """ return the most recent completed run or None """
+    for run in reversed(store.list_runs()):
+        if store.exists(run + "/" + MANIFEST):
+            return run
+        logger.info("Skip incomplete run %s", run)
+    return None
+
+
+def load_manifest(store, run):
+    """ return manifest of a completed run, listing processed and failed accounts """
+    if not store.exists(run + "/" + MANIFEST):
+        raise SnapshotError("Run " + run + " is not completed")
+    return json.loads(store.read(run + "/" + MANIFEST).decode("utf-8"))
+
+
+def load_snapshot(store, run):
+    """
+    return the run snapshot of a completed run as dictionary of columns
+    """
+    manifest = load_manifest(store, run)
+    if manifest["failed"]:
+        logger.warning(
+            "Run %s failed for accounts %s. Their snapshots may be missing or outdated.",
+            run,
+            ", ".join(manifest["failed"]),
+        )
+    return read_snapshot(store.read(run + "/" + RUN_SNAPSHOT))
+
+
+def query_snapshot(columns, **filters):
+    """
+    return rows of a snapshot matching all filters, e.g. query_snapshot(columns, status="DISABLED", controlId="CIS.1.1")
+    """
+    matches = range(len(columns["account"]))
+    for column, value in filters.items():
+        matches = [i for i in matches if columns[column][i] == value]
+    return [{column: columns[column][i] for column in SNAPSHOT_COLUMNS} for i in matches]
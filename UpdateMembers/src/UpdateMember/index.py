@@ -1,8 +1,13 @@
 #!/bin/python
 
+import gzip
+import hashlib
+import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import boto3
 import botocore
@@ -31,51 +36,210 @@ def get_enabled_standard_subscriptions(standards, account_id, security_hub_clien
     return enabled_standards
 
 
-def get_controls(enabled_standards, security_hub_client):
-    """ return list of controls for all aneabled standards """
-    controls = dict()
-    for standard in enabled_standards["StandardsSubscriptions"]:
+def get_standard_controls(standard, security_hub_client):
+    """ return list of controls for a single enabled standard """
+    response = security_hub_client.describe_standards_controls(
+        StandardsSubscriptionArn=standard["StandardsSubscriptionArn"])
+    controls = response["Controls"]
+
+    while "NextToken" in response:
+        next_token = response["NextToken"]
         response = security_hub_client.describe_standards_controls(
-            StandardsSubscriptionArn=standard["StandardsSubscriptionArn"])
-        controls[
-            standard["StandardsArn"]
-        ] = response["Controls"]
-        
-        while "NextToken" in response:
-            next_token = response["NextToken"]
-            response = security_hub_client.describe_standards_controls(
             StandardsSubscriptionArn=standard["StandardsSubscriptionArn"], NextToken=next_token)
-            controls[ standard["StandardsArn"] ] = controls[ standard["StandardsArn"] ] + response["Controls"]
+        controls = controls + response["Controls"]
     return controls
 
 
+def get_controls(enabled_standards, security_hub_client):
+    """ return list of controls for all aneabled standards. Standards are paginated in parallel. """
+    subscriptions = enabled_standards["StandardsSubscriptions"]
+    with ThreadPoolExecutor(max_workers=STANDARD_WORKERS) as executor:
+        controls = executor.map(
+            lambda standard: get_standard_controls(standard, security_hub_client),
+            subscriptions,
+        )
+        return {
+            standard["StandardsArn"]: standard_controls
+            for standard, standard_controls in zip(subscriptions, controls)
+        }
+
+
+def reconcile_standard(
+    administrator_standard, member_standard, administrator_client, member_client, exceptions, write
+):
+    """
+    Fetch the controls of a single standard and disable/enable them in the member account if write is set.
+    Return controls and changes of the standard.
+    """
+    standard_arn = member_standard["StandardsArn"]
+    member_controls = {standard_arn: get_standard_controls(member_standard, member_client)}
+    admin_controls = dict()
+    if administrator_standard:
+        admin_controls[standard_arn] = get_standard_controls(
+            administrator_standard, administrator_client
+        )
+
+    if write:
+        changes = update_member(admin_controls, member_controls, member_client, exceptions)
+    else:
+        changes = list(get_control_changes(admin_controls, member_controls, exceptions))
+    return {"memberControls": member_controls, "changes": changes}
+
+
+def reconcile_standards(
+    administrator_enabled_standards,
+    member_enabled_standards,
+    administrator_client,
+    member_client,
+    exceptions,
+    write=True,
+    update_subscriptions=None,
+):
+    """
+    Reconcile all standards enabled in the member account in parallel. The workers share the clients and thus
+    their client side rate limiters. Return results and errors per standard.
+
+    If given, update_subscriptions enables/disables standards in the member account and returns the member's
+    enabled standards if they changed. Only the standards being enabled wait for it. Standards enabled in
+    both accounts are reconciled meanwhile and standards being disabled are skipped.
+    """
+    administrator_standards = {
+        standard["StandardsArn"]: standard
+        for standard in administrator_enabled_standards["StandardsSubscriptions"]
+    }
+    results = dict()
+    errors = dict()
+    with ThreadPoolExecutor(max_workers=STANDARD_WORKERS) as executor:
+        futures = dict()
+
+        def submit(enabled_standards):
+            for standard in enabled_standards["StandardsSubscriptions"]:
+                standard_arn = standard["StandardsArn"]
+                if standard_arn in futures:
+                    continue
+                if update_subscriptions and standard_arn not in administrator_standards:
+                    # Standard is disabled by update_subscriptions
+                    continue
+                futures[standard_arn] = executor.submit(
+                    reconcile_standard,
+                    administrator_standards.get(standard_arn),
+                    standard,
+                    administrator_client,
+                    member_client,
+                    exceptions,
+                    write,
+                )
+
+        submit(member_enabled_standards)
+        if update_subscriptions:
+            updated_standards = update_subscriptions()
+            if updated_standards:
+                submit(updated_standards)
+
+        for standard_arn, future in futures.items():
+            try:
+                results[standard_arn] = future.result()
+                logger.info("%s: %d changes", standard_arn, len(results[standard_arn]["changes"]))
+            except botocore.exceptions.ClientError as error:
+                logger.error("%s: %s", standard_arn, error)
+                errors[standard_arn] = str(error)
+    return results, errors
+
+
 class SecurityStandardUpdateError(Exception):
     """ Error Class for failed security standard subscription update """
 
     pass
 
 
+class ChangePlanError(Exception):
+    """ Error Class for change plans which cannot be read """
+
+    pass
+
+
+class InvalidInputError(Exception):
+    """ Error Class for invalid mode or plan name in the event """
+
+    pass
+
+
 administrator_security_hub_client = None
 sts_client = None
+s3_client = None
+dynamodb_client = None
 DISABLED_REASON = "Control disabled in the SecurityHub administrator account."
+EXCEPTION_DISABLED_REASON = "Exception"
+EXCEPTIONS_SCHEMA_V2 = "v2"
+EXCEPTIONS_ACCOUNT_INDEX = "AccountId"
 DISABLED = "DISABLED"
 ENABLED = "ENABLED"
+MODE_UPDATE = "update"
+MODE_PLAN = "plan"
+MODE_APPLY = "apply"
+MODES = (MODE_UPDATE, MODE_PLAN, MODE_APPLY)
+REASON_EXCEPTION = "Exception"
+REASON_ADMINISTRATOR = "Administrator"
+PLAN_VERSION = 1
+APPLY_WORKERS = 4
+STANDARD_WORKERS = 4
+SNAPSHOT_VERSION = 2
+SNAPSHOT_COLUMNS = ("account", "standard", "controlId", "controlArn", "status", "disabledReason", "exceptionSource")
+call_metrics = {"calls": 0, "retries": 0, "throttleWait": 0}
+call_metrics_lock = threading.Lock()
+send_timer = threading.local()
+
+
+def count_call(parsed, **kwargs):
+    """ count Security Hub API calls and their retries (mostly caused by throttling) """
+    with call_metrics_lock:
+        call_metrics["calls"] += 1
+        call_metrics["retries"] += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+
+def start_send(**kwargs):
+    """ remember when a request is handed to the client side rate limiter (adaptive retry mode) """
+    send_timer.start = time.monotonic()
+
+
+def end_send(**kwargs):
+    """ add the time a request waited on the client side rate limiter """
+    now = time.monotonic()
+    wait = now - getattr(send_timer, "start", now)
+    with call_metrics_lock:
+        call_metrics["throttleWait"] += wait
+
+
+def register_metrics(client):
+    """
+    Count API calls and retries and measure the time spent waiting on the client side rate limiter.
+    The limiter is a "before-send" handler, so it runs between the first and the last handler registered here.
+    """
+    client.meta.events.register("after-call.securityhub", count_call)
+    client.meta.events.register_first("before-send", start_send)
+    client.meta.events.register_last("before-send", end_send)
 
 
 def lambda_handler(event, context):
 
     logger.info(event)
 
+    start = time.monotonic()
+    call_metrics["calls"] = 0
+    call_metrics["retries"] = 0
+    call_metrics["throttleWait"] = 0
+
     try:
         # set variables and boto3 clients
         config = Config(
             retries = {
                 'max_attempts': 23,
-                'mode': 'standard'
+                'mode': 'adaptive'
                 }
             )
         administrator_account_id = context.invoked_function_arn.split(":")[4]
         member_account_id = event["account"]
+        mode = get_mode(event)
 
         role_arn = os.environ["MemberRole"].replace("<accountId>", member_account_id)
         global sts_client
@@ -92,14 +256,52 @@ def lambda_handler(event, context):
             aws_session_token=credentials["SessionToken"],
             config=config,
         )
+        register_metrics(member_security_hub_client)
 
         # Optimization - no need to reinitilize the administrator security hub client for every instance of this Lambda function
         global administrator_security_hub_client
         if not administrator_security_hub_client:
             administrator_security_hub_client = boto3.client("securityhub", config=config)
+            register_metrics(administrator_security_hub_client)
 
         # Get standard subscription controls
         standards = administrator_security_hub_client.describe_standards()
+
+        if mode == MODE_APPLY:
+            logger.info("Apply change plan %s to account %s", event["plan"], member_account_id)
+            member_enabled_standards = get_enabled_standard_subscriptions(
+                standards, member_account_id, member_security_hub_client
+            )
+            member_controls = get_controls(
+                member_enabled_standards, member_security_hub_client
+            )
+            serialized_plan = load_plan(event["plan"], member_account_id)
+            if serialized_plan is None:
+                # e.g. account joined after the plan was created
+                logger.info("No change plan for account %s", member_account_id)
+                plan = []
+            else:
+                plan = read_plan(serialized_plan, member_account_id)
+            # Exceptions are only needed for the snapshot, so failing to load them must not fail the account
+            exceptions = None
+            if "run" in event:
+                try:
+                    exceptions = load_exceptions(event)
+                except botocore.exceptions.ClientError as error:
+                    logger.error("Exceptions of account %s could not be loaded, skip snapshot: %s", member_account_id, error)
+            applied, failed, stale = apply_plan(plan, member_controls, member_security_hub_client)
+            if exceptions is not None:
+                export_snapshot(member_account_id, member_controls, exceptions, applied, event["run"])
+            response = {"statusCode": 200, "account": member_account_id, "changes": len(applied), "stale": stale, "metrics": get_metrics(start)}
+            if failed:
+                response["statusCode"] = 500
+                response["failed"] = [change["controlArn"] for change, _ in failed]
+                response["error"] = (
+                    str(len(failed)) + " of " + str(len(plan)) + " changes failed: "
+                    + "; ".join(sorted(set(error for _, error in failed)))
+                )
+            return response
+
         administrator_enabled_standards = get_enabled_standard_subscriptions(
             standards, administrator_account_id, administrator_security_hub_client
         )
@@ -109,47 +311,89 @@ def lambda_handler(event, context):
 
         logger.info("Update Account %s", member_account_id)
 
-        # Update standard subscriptions in member account
-        standards_updated = update_standard_subscription(
+        # Get exceptions
+        exceptions = load_exceptions(event)
+        logger.debug("Exceptions: %s", str(exceptions))
+
+        def update_subscriptions():
+            """ Update standard subscriptions in member account. Return enabled standards if they changed. """
+            if update_standard_subscription(
+                administrator_enabled_standards,
+                member_enabled_standards,
+                member_security_hub_client,
+            ):
+                logger.info("Fetch enabled standards again.")
+                return get_enabled_standard_subscriptions(
+                    standards, member_account_id, member_security_hub_client
+                )
+            return None
+
+        # Get controls and disable/enable them in member account, one worker per standard.
+        # A plan must not change anything, so standard subscriptions are only updated outside of plan mode.
+        results, errors = reconcile_standards(
             administrator_enabled_standards,
             member_enabled_standards,
+            administrator_security_hub_client,
             member_security_hub_client,
+            exceptions,
+            write=mode != MODE_PLAN,
+            update_subscriptions=update_subscriptions if mode != MODE_PLAN else None,
         )
-        if standards_updated:
-            logger.info("Fetch enabled standards again.")
-            member_enabled_standards = get_enabled_standard_subscriptions(
-                standards, member_account_id, member_security_hub_client
-            )
+        if errors:
+            error = "; ".join(standard + ": " + errors[standard] for standard in errors)
+            return {"statusCode": 500, "account": member_account_id, "error": error, "metrics": get_metrics(start)}
+
+        member_controls = dict()
+        changes = []
+        for result in results.values():
+            member_controls.update(result["memberControls"])
+            changes += result["changes"]
+
+        if mode == MODE_PLAN:
+            plan = plan_member(changes, member_account_id)
+            store_plan(write_plan(plan, member_account_id), event["plan"], member_account_id)
+            if "run" in event:
+                export_snapshot(member_account_id, member_controls, exceptions, [], event["run"])
+            return {"statusCode": 200, "account": member_account_id, "changes": len(plan), "metrics": get_metrics(start)}
+
+        # Export control states for reporting
+        if "run" in event:
+            export_snapshot(member_account_id, member_controls, exceptions, changes, event["run"])
+
+    except (botocore.exceptions.ClientError, ChangePlanError, InvalidInputError) as error:
+        logger.error(error)
+        return {"statusCode": 500, "account": member_account_id, "error": str(error), "metrics": get_metrics(start)}
 
-        # Get Controls
-        admin_controls = get_controls(
-            administrator_enabled_standards, administrator_security_hub_client
-        )
-        member_controls = get_controls(
-            member_enabled_standards, member_security_hub_client
-        )
+    return {"statusCode": 200, "account": member_account_id, "metrics": get_metrics(start)}
 
-        # Get exceptions
-        exceptions = get_exceptions(event)
-        logger.debug("Exceptions: %s", str(exceptions))
 
-        # Disable/enable the controls in member account
-        update_member(
-            admin_controls, member_controls, member_security_hub_client, exceptions
+def get_mode(event):
+    """
+    return mode of the event. Unknown modes and plan/apply without plan name are rejected.
+    """
+    mode = event.get("mode", MODE_UPDATE)
+    if mode not in MODES:
+        raise InvalidInputError(
+            "Unknown mode '" + str(mode) + "'. Valid modes: " + ", ".join(MODES)
         )
+    if mode != MODE_UPDATE and (not isinstance(event.get("plan"), str) or event["plan"] == ""):
+        raise InvalidInputError("Mode '" + mode + "' requires a plan name.")
+    return mode
 
-    except botocore.exceptions.ClientError as error:
-        logger.error(error)
-        return {"statusCode": 500, "account": member_account_id, "error": str(error)}
 
-    return {"statusCode": 200, "account": member_account_id}
+def get_metrics(start):
+    """ return duration and API call metrics of this invocation """
+    return {
+        "duration": time.monotonic() - start,
+        "calls": call_metrics["calls"],
+        "retries": call_metrics["retries"],
+        "throttleWait": call_metrics["throttleWait"],
+    }
 
 
-def update_member(
-    admin_controls, member_controls, member_security_hub_client, exceptions
-):
+def get_control_changes(admin_controls, member_controls, exceptions):
     """
-    Identifying which control needs to be updated
+    Identifying which control needs to be updated. Yields member control, new status, disabled reason and source of the change.
     """
 
     for admin_key in admin_controls:
@@ -165,30 +409,288 @@ def update_member(
                     if admin_control["ControlId"] in exceptions["Disabled"]:
                         if member_control["ControlStatus"] != DISABLED:
                             # Disable control in member account
-                            update_control_status(
+                            yield (
                                 member_control,
-                                member_security_hub_client,
                                 DISABLED,
-                                disabled_reason=exceptions["DisabledReason"][
-                                    admin_control["ControlId"]
-                                ],
+                                exceptions["DisabledReason"][admin_control["ControlId"]],
+                                REASON_EXCEPTION,
                             )
                     elif admin_control["ControlId"] in exceptions["Enabled"]:
                         if member_control["ControlStatus"] != ENABLED:
                             # Enable control in member account
-                            update_control_status(
-                                member_control, member_security_hub_client, ENABLED
-                            )
+                            yield member_control, ENABLED, None, REASON_EXCEPTION
                     elif (
                         admin_control["ControlStatus"]
                         != member_control["ControlStatus"]
                     ):
                         # Update control in member account to reflect configuration in SecurityHub admin account
-                        update_control_status(
-                            member_control,
-                            member_security_hub_client,
-                            admin_control["ControlStatus"],
-                        )
+                        yield member_control, admin_control["ControlStatus"], None, REASON_ADMINISTRATOR
+
+
+def update_member(
+    admin_controls, member_controls, member_security_hub_client, exceptions
+):
+    """
+    Disable/enable the controls in the member account. Return list of changes.
+    """
+    changes = list(get_control_changes(admin_controls, member_controls, exceptions))
+    for member_control, new_status, disabled_reason, _ in changes:
+        if disabled_reason:
+            update_control_status(
+                member_control,
+                member_security_hub_client,
+                new_status,
+                disabled_reason=disabled_reason,
+            )
+        else:
+            update_control_status(
+                member_control, member_security_hub_client, new_status
+            )
+    return changes
+
+
+def get_fingerprint(member_control):
+    """
+    return fingerprint of the member control state a change was planned against
+    """
+    state = "|".join(
+        [
+            member_control["StandardsControlArn"],
+            member_control["ControlStatus"],
+            member_control.get("DisabledReason", ""),
+        ]
+    )
+    return hashlib.sha256(state.encode("utf-8")).hexdigest()[:16]
+
+
+def plan_member(changes, account_id):
+    """
+    Convert the changes computed by get_control_changes into the change plan for the member account
+    """
+    plan = []
+    for member_control, new_status, disabled_reason, reason in changes:
+        change = {
+            "account": account_id,
+            "controlArn": member_control["StandardsControlArn"],
+            "status": new_status,
+            "reason": reason,
+            "fingerprint": get_fingerprint(member_control),
+        }
+        if disabled_reason:
+            change["disabledReason"] = disabled_reason
+        plan.append(change)
+    return plan
+
+
+def get_snapshot_controls(columns, account_id):
+    """
+    return the controls of account_id stored in a control state snapshot in the format returned by get_controls
+    """
+    controls = dict()
+    for i in range(len(columns["account"])):
+        if columns["account"][i] != account_id:
+            continue
+        control = {
+            "StandardsControlArn": columns["controlArn"][i],
+            "ControlId": columns["controlId"][i],
+            "ControlStatus": columns["status"][i],
+        }
+        if columns["disabledReason"][i] != "":
+            control["DisabledReason"] = columns["disabledReason"][i]
+        controls.setdefault(columns["standard"][i], []).append(control)
+    return controls
+
+
+def plan_from_snapshot(columns, account_id, admin_controls, exceptions):
+    """
+    Create the change plan of account_id from a control state snapshot instead of the member's Security Hub.
+    The fingerprints match the member controls as long as they did not change since the snapshot was taken.
+    """
+    member_controls = get_snapshot_controls(columns, account_id)
+    return plan_member(list(get_control_changes(admin_controls, member_controls, exceptions)), account_id)
+
+
+def write_plan(plan, account_id):
+    """
+    Serialize change plan as JSON Lines. The first line is a header containing the plan version.
+    """
+    lines = [json.dumps({"version": PLAN_VERSION, "account": account_id, "changes": len(plan)})]
+    lines += [json.dumps(change, separators=(",", ":")) for change in plan]
+    return "\n".join(lines) + "\n"
+
+
+def read_plan(lines, account_id):
+    """
+    Deserialize change plan of account_id from JSON Lines. Plans of other accounts and truncated plans are rejected.
+    """
+    lines = [line for line in lines.splitlines() if line.strip()]
+    if not lines:
+        raise ChangePlanError("Change plan is empty")
+    try:
+        header = json.loads(lines[0])
+        if not isinstance(header, dict):
+            raise ChangePlanError("Change plan has no header")
+        if header.get("version") != PLAN_VERSION:
+            raise ChangePlanError(
+                "Unsupported change plan version: " + str(header.get("version"))
+            )
+        if header.get("account") != account_id:
+            raise ChangePlanError(
+                "Change plan of account " + str(header.get("account")) + " cannot be applied to account " + account_id
+            )
+        plan = [json.loads(line) for line in lines[1:]]
+    except json.JSONDecodeError as error:
+        raise ChangePlanError("Change plan is not valid JSON Lines: " + str(error))
+    if header.get("changes") != len(plan):
+        raise ChangePlanError(
+            "Change plan is incomplete: " + str(len(plan)) + " of " + str(header.get("changes")) + " changes found"
+        )
+    for change in plan:
+        if not isinstance(change, dict) or any(
+            key not in change for key in ("controlArn", "status", "fingerprint")
+        ):
+            raise ChangePlanError("Invalid change in change plan: " + str(change))
+    return plan
+
+
+def store_plan(plan, plan_id, account_id):
+    """ store serialized change plan of account_id in S3 """
+    global s3_client
+    if not s3_client:
+        s3_client = boto3.client("s3")
+    s3_client.put_object(
+        Bucket=os.environ["ChangePlans"],
+        Key=plan_id + "/" + account_id + ".jsonl",
+        Body=plan.encode("utf-8"),
+    )
+
+
+def load_plan(plan_id, account_id):
+    """ return serialized change plan of account_id from S3 or None if no plan exists for the account """
+    global s3_client
+    if not s3_client:
+        s3_client = boto3.client("s3")
+    try:
+        response = s3_client.get_object(
+            Bucket=os.environ["ChangePlans"], Key=plan_id + "/" + account_id + ".jsonl"
+        )
+    except botocore.exceptions.ClientError as error:
+        if error.response.get("Error", {}).get("Code") == "NoSuchKey":
+            return None
+        raise error
+    return response["Body"].read().decode("utf-8")
+
+
+def apply_plan(plan, member_controls, member_security_hub_client):
+    """
+    Apply change plan in parallel. Changes whose member control changed since planning are skipped as stale.
+    Return list of applied changes, list of failed changes with their error and number of stale changes.
+    """
+    current_controls = {
+        control["StandardsControlArn"]: control
+        for controls in member_controls.values()
+        for control in controls
+    }
+    pending = []
+    stale = 0
+    for change in plan:
+        member_control = current_controls.get(change["controlArn"])
+        if member_control is None or get_fingerprint(member_control) != change["fingerprint"]:
+            logger.warning("Skip stale change: %s", str(change))
+            stale += 1
+            continue
+        pending.append((member_control, change))
+
+    def apply_change(pending_change):
+        """ return None if the change was applied, otherwise the error """
+        member_control, change = pending_change
+        try:
+            update_control_status(
+                member_control,
+                member_security_hub_client,
+                change["status"],
+                disabled_reason=change.get("disabledReason"),
+            )
+        except botocore.exceptions.ClientError as error:
+            logger.error("Change of %s failed: %s", change["controlArn"], error)
+            return str(error)
+        return None
+
+    applied = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=APPLY_WORKERS) as executor:
+        for (member_control, change), error in zip(pending, executor.map(apply_change, pending)):
+            if error:
+                failed.append((change, error))
+            else:
+                applied.append((member_control, change["status"], change.get("disabledReason"), change["reason"]))
+    return applied, failed, stale
+
+
+def get_snapshot_rows(account_id, member_controls, exceptions, changes):
+    """
+    return control states of the member account after applying changes
+    """
+    changed = {
+        member_control["StandardsControlArn"]: (new_status, disabled_reason)
+        for member_control, new_status, disabled_reason, _ in changes
+    }
+    exception_controls = set(exceptions["Disabled"] + exceptions["Enabled"])
+    rows = []
+    for standard, controls in member_controls.items():
+        for control in controls:
+            status = control["ControlStatus"]
+            disabled_reason = control.get("DisabledReason", "")
+            if control["StandardsControlArn"] in changed:
+                status, disabled_reason = changed[control["StandardsControlArn"]]
+                if status == DISABLED:
+                    disabled_reason = disabled_reason if disabled_reason else DISABLED_REASON
+                else:
+                    disabled_reason = ""
+            if control["ControlId"] in exception_controls:
+                exception_source = REASON_EXCEPTION
+            else:
+                exception_source = REASON_ADMINISTRATOR
+            rows.append(
+                {
+                    "account": account_id,
+                    "standard": standard,
+                    "controlId": control["ControlId"],
+                    "controlArn": control["StandardsControlArn"],
+                    "status": status,
+                    "disabledReason": disabled_reason,
+                    "exceptionSource": exception_source,
+                }
+            )
+    return rows
+
+
+def write_snapshot(rows):
+    """
+    Serialize snapshot rows into gzip compressed columnar JSON. Read with src/Reporting/snapshot.py.
+    """
+    columns = {column: [row[column] for row in rows] for column in SNAPSHOT_COLUMNS}
+    data = json.dumps({"version": SNAPSHOT_VERSION, "columns": columns}, separators=(",", ":"))
+    return gzip.compress(data.encode("utf-8"))
+
+
+def export_snapshot(account_id, member_controls, exceptions, changes, run):
+    """
+    store control state snapshot of account_id in S3. The snapshot is only used for reporting,
+    so failures are logged and do not fail the update of the account.
+    """
+    global s3_client
+    if not s3_client:
+        s3_client = boto3.client("s3")
+    try:
+        rows = get_snapshot_rows(account_id, member_controls, exceptions, changes)
+        s3_client.put_object(
+            Bucket=os.environ["ControlSnapshots"],
+            Key=run + "/" + account_id + ".json.gz",
+            Body=write_snapshot(rows),
+        )
+    except botocore.exceptions.ClientError as error:
+        logger.error("Control state snapshot of account %s could not be stored: %s", account_id, error)
 
 
 def update_control_status(member_control, client, new_status, disabled_reason=None):
@@ -323,6 +825,50 @@ def update_standard_subscription(
     return standards_changed
 
 
+def load_exceptions(event):
+    """
+    return exceptions of the processed account. With the v2 schema, only the exceptions of this account are queried.
+    """
+    if os.environ.get("ExceptionsSchema") == EXCEPTIONS_SCHEMA_V2:
+        global dynamodb_client
+        if not dynamodb_client:
+            dynamodb_client = boto3.client("dynamodb")
+        event = dict(event)
+        event["exceptions"] = get_account_exceptions(
+            dynamodb_client, os.environ["DynamoDBV2"], event["account"]
+        )
+    return get_exceptions(event)
+
+
+def get_account_exceptions(client, table_name, account_id):
+    """
+    Query exceptions of account_id from the v2 exceptions table. Return them in the same format as the exceptions in the event.
+    """
+    kwargs = dict(
+        TableName=table_name,
+        IndexName=EXCEPTIONS_ACCOUNT_INDEX,
+        KeyConditionExpression="AccountId = :account",
+        ExpressionAttributeValues={":account": {"S": account_id}},
+    )
+    items = []
+    while True:
+        response = client.query(**kwargs)
+        items += response["Items"]
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    exceptions = dict()
+    for item in items:
+        disabled_reason = item.get("DisabledReason", {}).get("S", "")
+        exceptions[item["ControlId"]["S"]] = {
+            "Disabled": [account_id] if item.get("Disabled", {}).get("BOOL") else [],
+            "Enabled": [account_id] if item.get("Enabled", {}).get("BOOL") else [],
+            "DisabledReason": disabled_reason if disabled_reason else EXCEPTION_DISABLED_REASON,
+        }
+    return exceptions
+
+
 def get_exceptions(event):
     """
     extract exceptions related to the processed account from event. Return dictionary.
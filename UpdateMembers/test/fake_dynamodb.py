@@ -0,0 +1,67 @@
+"""
+In-memory stand-in for the DynamoDB client calls used by the Lambda functions.
+Results are paginated with a small page size to exercise pagination.
+"""
+
+
+class FakeDynamoDB:
+    def __init__(self, page_size=2, unprocessed_writes=0):
+        self.tables = dict()
+        self.page_size = page_size
+        # number of batch_write_item calls returning all items as unprocessed
+        self.unprocessed_writes = unprocessed_writes
+
+    def create_table(self, table_name, hash_key, range_key=None, indexes=None):
+        self.tables[table_name] = {
+            "keys": [key for key in (hash_key, range_key) if key],
+            "indexes": indexes if indexes else dict(),
+            "items": [],
+        }
+
+    def put(self, table_name, item):
+        table = self.tables[table_name]
+        key = [item[attribute] for attribute in table["keys"]]
+        table["items"] = [
+            existing for existing in table["items"]
+            if [existing[attribute] for attribute in table["keys"]] != key
+        ]
+        table["items"].append(item)
+
+    def delete(self, table_name, key):
+        table = self.tables[table_name]
+        table["items"] = [
+            item for item in table["items"]
+            if any(item[attribute] != key[attribute] for attribute in table["keys"])
+        ]
+
+    def _page(self, items, ExclusiveStartKey=None):
+        start = ExclusiveStartKey["Offset"] if ExclusiveStartKey else 0
+        response = {"Items": items[start : start + self.page_size]}
+        if start + self.page_size < len(items):
+            response["LastEvaluatedKey"] = {"Offset": start + self.page_size}
+        return response
+
+    def scan(self, TableName, ExclusiveStartKey=None):
+        return self._page(self.tables[TableName]["items"], ExclusiveStartKey)
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, IndexName=None, ExclusiveStartKey=None):
+        table = self.tables[TableName]
+        # Only simple equality conditions on the hash key, e.g. "AccountId = :account"
+        attribute, placeholder = [part.strip() for part in KeyConditionExpression.split("=")]
+        hash_key = table["indexes"][IndexName] if IndexName else table["keys"][0]
+        assert attribute == hash_key
+        items = [item for item in table["items"] if item.get(attribute) == ExpressionAttributeValues[placeholder]]
+        return self._page(items, ExclusiveStartKey)
+
+    def batch_write_item(self, RequestItems):
+        assert sum(len(requests) for requests in RequestItems.values()) <= 25
+        if self.unprocessed_writes > 0:
+            self.unprocessed_writes -= 1
+            return {"UnprocessedItems": RequestItems}
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                if "PutRequest" in request:
+                    self.put(table_name, request["PutRequest"]["Item"])
+                else:
+                    self.delete(table_name, request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": {}}
@@ -1,6 +1,10 @@
+import gzip
 import json
+import botocore
 import pytest
 import src.CheckResult.index as CheckResult
+import src.UpdateMember.index as UpdateMember
+from unittest.mock import patch, MagicMock
 
 
 def test_lambda_handler():
@@ -12,3 +16,99 @@ def test_lambda_handler():
     assert expected_response_failed == response_failed
     response_success = CheckResult.lambda_handler(event_success, {})
     assert expected_response_success == response_success
+
+
+def test_get_run_metrics():
+    processed_items = [
+        {"statusCode": 200, "account": "acc_1", "metrics": {"duration": 10, "calls": 20, "retries": 1}},
+        {"statusCode": 500, "account": "acc_2", "error": "An error occurred (TooManyRequestsException) when calling the UpdateStandardsControl operation: Rate exceeded", "metrics": {"duration": 20, "calls": 30, "retries": 3}},
+        {"statusCode": 500, "account": "acc_3", "error": "An error occurred (AccessDenied) when calling the AssumeRole operation", "metrics": {"duration": 0, "calls": 0, "retries": 0}},
+    ]
+    expected_response = {"Concurrency": 3, "Accounts": 3, "Failures": 2, "Throttled": 1, "Duration": 10, "Calls": 50, "Retries": 4, "ThrottleWait": 0}
+    response = CheckResult.get_run_metrics(processed_items, {"concurrency": 3})
+    assert expected_response == response
+
+
+@patch("src.CheckResult.index.os")
+@patch("src.CheckResult.index.boto3")
+def test_lambda_handler_save_run_metrics(boto3, os):
+    os.environ = {"RunMetrics": "table"}
+    event = {"processedItems": [{"statusCode": 200, "account": "acc_1", "metrics": {"duration": 10, "calls": 20, "retries": 1}}], "tuning": {"concurrency": 3}}
+    response = CheckResult.lambda_handler(event, {})
+    assert response == {"statusCode": 200}
+    item = boto3.client.return_value.put_item.call_args.kwargs["Item"]
+    assert item["Metric"] == {"S": CheckResult.RUN_METRICS_KEY}
+    assert item["Concurrency"] == {"N": "3"}
+    assert item["Duration"] == {"N": "10.0"}
+
+
+@patch("src.CheckResult.index.os")
+@patch("src.CheckResult.index.boto3")
+def test_lambda_handler_skip_plan_run_metrics(boto3, os):
+    event = {"processedItems": [{"statusCode": 200, "account": "acc_1", "changes": 0, "metrics": {"duration": 1, "calls": 2, "retries": 0}}], "tuning": {"concurrency": 3}, "mode": "plan"}
+    response = CheckResult.lambda_handler(event, {})
+    assert response == {"statusCode": 200}
+    boto3.client.return_value.put_item.assert_not_called()
+
+
+@patch("src.CheckResult.index.os")
+@patch("src.CheckResult.index.boto3")
+def test_lambda_handler_snapshot_manifest(boto3, os):
+    os.environ = {"ControlSnapshots": "bucket"}
+    event = {"processedItems": [{"statusCode": 200, "account": "acc_2"}, {"statusCode": 500, "account": "acc_1", "error": "Reason"}, {"statusCode": 200, "account": "acc_0"}], "run": "run_1"}
+    client = MagicMock()
+    with patch.object(CheckResult, "s3_client", client):
+        response = CheckResult.lambda_handler(event, {})
+        assert response == {"statusCode": 500, "failed_accounts": {"acc_1": "Reason"}}
+        assert client.put_object.call_args.kwargs["Key"] == "run_1/" + CheckResult.SNAPSHOT_MANIFEST
+        manifest = json.loads(client.put_object.call_args.kwargs["Body"])
+        assert manifest == {"run": "run_1", "processed": ["acc_0", "acc_2"], "failed": ["acc_1"]}
+
+
+def get_s3_client(objects):
+    """ return S3 client mock storing objects in the given dictionary """
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.side_effect = lambda Bucket, Prefix: [
+        {"Contents": [{"Key": key} for key in sorted(objects) if key.startswith(Prefix)]}
+    ]
+    client.get_object.side_effect = lambda Bucket, Key: {"Body": MagicMock(read=MagicMock(return_value=objects[Key]))}
+    client.put_object.side_effect = lambda Bucket, Key, Body: objects.update({Key: Body})
+
+    def delete_objects(Bucket, Delete):
+        for deleted in Delete["Objects"]:
+            del objects[deleted["Key"]]
+
+    client.delete_objects.side_effect = delete_objects
+    return client
+
+
+def test_complete_snapshot():
+    """
+    The account snapshots of a run are merged into a single run snapshot
+    """
+    row = {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "disabledReason": "SomeReason", "exceptionSource": "Exception"}
+    objects = {
+        "run_1/acc_1.json.gz": UpdateMember.write_snapshot([row]),
+        "run_1/acc_2.json.gz": UpdateMember.write_snapshot([dict(row, account="acc_2"), dict(row, account="acc_2", controlId="CIS.1.2")]),
+        "run_2/acc_1.json.gz": UpdateMember.write_snapshot([row]),
+    }
+    client = get_s3_client(objects)
+    processed_items = [{"statusCode": 200, "account": "acc_1"}, {"statusCode": 200, "account": "acc_2"}]
+    CheckResult.complete_snapshot(processed_items, "run_1", client, "bucket")
+
+    assert sorted(objects) == ["run_1/" + CheckResult.SNAPSHOT_MANIFEST, "run_1/" + CheckResult.SNAPSHOT_RUN, "run_2/acc_1.json.gz"]
+    snapshot = json.loads(gzip.decompress(objects["run_1/" + CheckResult.SNAPSHOT_RUN]))
+    assert snapshot["version"] == UpdateMember.SNAPSHOT_VERSION
+    assert snapshot["columns"]["account"] == ["acc_1", "acc_2", "acc_2"]
+    assert snapshot["columns"]["controlId"] == ["CIS.1.1", "CIS.1.1", "CIS.1.2"]
+
+
+def test_complete_snapshot_fail():
+    """
+    A run whose account snapshots cannot be merged stays incomplete
+    """
+    objects = {"run_1/acc_1.json.gz": b""}
+    client = get_s3_client(objects)
+    client.get_object.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+    CheckResult.complete_snapshot([{"statusCode": 200, "account": "acc_1"}], "run_1", client, "bucket")
+    assert list(objects) == ["run_1/acc_1.json.gz"]
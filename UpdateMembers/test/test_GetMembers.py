@@ -1,6 +1,7 @@
 import json
 import pytest
 import src.GetMembers.index as GetMembers
+from unittest.mock import MagicMock
 
 
 def test_convert_exceptions():
@@ -8,3 +9,92 @@ def test_convert_exceptions():
     expected_response = {"CIS.1.1": {"Disabled": ["111111111111"], "Enabled": [], "DisabledReason": "Some_Reason"}, "CIS.1.2": {"Disabled": [], "Enabled": ["22222222222"], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.3": {"Disabled": [], "Enabled": ["22222222222"], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.4": {"Disabled": ["111111111111"], "Enabled": [], "DisabledReason": GetMembers.DISABLED_REASON}, "CIS.1.5": {"Disabled": [], "Enabled": [], "DisabledReason": GetMembers.DISABLED_REASON}}
     response = GetMembers.convert_exceptions(dynamodb_response)
     assert expected_response == response
+
+
+def test_convert_run_metrics():
+    dynamodb_response = json.loads('{"Items": [{"Metric": {"S": "UpdateMembers"}, "Timestamp": {"N": "1700000000"}, "Concurrency": {"N": "3"}, "Accounts": {"N": "100"}, "Failures": {"N": "1"}, "Throttled": {"N": "0"}, "Duration": {"N": "12.5"}, "Calls": {"N": "2000"}, "Retries": {"N": "4"}}]}')
+    expected_response = [{"Timestamp": 1700000000, "Concurrency": 3, "Accounts": 100, "Failures": 1, "Throttled": 0, "Duration": 12.5, "Calls": 2000, "Retries": 4}]
+    response = GetMembers.convert_run_metrics(dynamodb_response)
+    assert expected_response == response
+    assert isinstance(response[0]["Concurrency"], int)
+
+
+def test_tune_concurrency_no_history():
+    response = GetMembers.tune_concurrency([], 100, 10, 3600, 20)
+    assert response == {"concurrency": GetMembers.DEFAULT_CONCURRENCY}
+
+
+def test_tune_concurrency_replay():
+    """
+    Replay a recorded run history (oldest first) and check the concurrency chosen before each run.
+    Every account takes 10s and 20 API calls, i.e. 2 calls per second and worker.
+    """
+    recorded_runs = [
+        {"Concurrency": 3, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 10},
+        {"Concurrency": 3, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 10},
+        {"Concurrency": 5, "Accounts": 1000, "Failures": 4, "Throttled": 4, "Duration": 10, "Calls": 20000, "Retries": 1500},
+        {"Concurrency": 2, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 0},
+        {"Concurrency": 3, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 0},
+        {"Concurrency": 4, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 0},
+    ]
+    # 1000 accounts * 10s within 3600s need a concurrency of 3, a deadline of 1800s needs 6 but 10 calls/s allow only 5.
+    # After the throttled run with 5, the concurrency recovers in steps of 1 and stays below 5.
+    deadlines = [3600, 3600, 1800, 1800, 1800, 1800, 1800]
+    expected_concurrency = [GetMembers.DEFAULT_CONCURRENCY, 3, 5, 2, 3, 4, 4]
+
+    # Replay the history as stored by CheckResult
+    items = [{key: {"N": str(value)} for key, value in run.items()} for run in recorded_runs]
+    chosen = []
+    for i, deadline in enumerate(deadlines):
+        history = GetMembers.convert_run_metrics({"Items": list(reversed(items[:i]))})
+        chosen.append(GetMembers.tune_concurrency(history, 1000, 10, deadline, 20)["concurrency"])
+    assert chosen == expected_concurrency
+    assert all(isinstance(concurrency, int) for concurrency in chosen)
+
+
+def test_tune_concurrency_running_executions():
+    """
+    Two running executions share the target API rate of 10 calls/s, i.e. 5 calls/s or 2 workers each
+    """
+    history = [{"Concurrency": 3, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 20000, "Retries": 0}]
+    response = GetMembers.tune_concurrency(history, 1000, 10, 1800, 20, running_executions=2)
+    assert response["rateConcurrency"] == 2
+    assert response["concurrency"] == 2
+
+
+def test_count_running_executions():
+    client = MagicMock()
+    client.list_executions.side_effect = [{"executions": [{}, {}], "nextToken": "token"}, {"executions": [{}]}]
+    assert GetMembers.count_running_executions(client, "arn") == 3
+    client.list_executions.assert_called_with(stateMachineArn="arn", statusFilter="RUNNING", nextToken="token")
+
+    client.list_executions.side_effect = [{"executions": []}]
+    assert GetMembers.count_running_executions(client, "arn") == 1
+
+
+def test_tune_concurrency_max():
+    history = [{"Concurrency": 3, "Accounts": 1000, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 1000, "Retries": 0}]
+    response = GetMembers.tune_concurrency(history, 1000, 100, 60, 20)
+    assert response["concurrency"] == 20
+    assert response["deadlineConcurrency"] == 167
+
+
+def test_get_mode():
+    assert GetMembers.get_mode({"scheduled": "True"}) == ("update", "")
+    assert GetMembers.get_mode({"mode": "plan", "plan": "plan_1"}) == ("plan", "plan_1")
+    with pytest.raises(GetMembers.InvalidInputError):
+        GetMembers.get_mode({"mode": "Plan", "plan": "plan_1"})
+    with pytest.raises(GetMembers.InvalidInputError):
+        GetMembers.get_mode({"mode": "apply"})
+    with pytest.raises(GetMembers.InvalidInputError):
+        GetMembers.get_mode({"mode": "apply", "plan": ""})
+
+
+def test_is_throttled_wait():
+    """
+    Adaptive retry mode delays requests on the client instead of retrying them
+    """
+    run = {"Concurrency": 4, "Accounts": 100, "Failures": 0, "Throttled": 0, "Duration": 10, "Calls": 2000, "Retries": 0, "ThrottleWait": 50}
+    assert not GetMembers.is_throttled(run)
+    run["ThrottleWait"] = 200
+    assert GetMembers.is_throttled(run)
@@ -0,0 +1,82 @@
+import json
+import pytest
+import src.MigrateExceptions.index as MigrateExceptions
+import src.GetMembers.index as GetMembers
+import src.UpdateMember.index as UpdateMember
+from unittest.mock import patch
+from test.fake_dynamodb import FakeDynamoDB
+
+V1_ITEMS = json.loads('[{"ControlId": {"S": "CIS.1.1"}, "Disabled": {"L": [{"S": "111111111111"}]}, "Enabled": {"L": []}, "DisabledReason": {"S": "Some_Reason"}}, {"Disabled": {"L": []}, "ControlId": {"S": "CIS.1.2"}, "Enabled": {"L": [{"S": "111111111111"}]}}, {"ControlId": {"S": "CIS.1.3"}, "Enabled": {"L": [{"S": "222222222222"}]}, "DisabledReason": {"S": ""}}, {"Disabled": {"L": [{"S": "222222222222"}]}, "ControlId": {"S": "CIS.1.4"}}, {"ControlId": {"S": "CIS.1.5"}, "Disabled": {"L": [{"S": "222222222222"}]}, "Enabled": {"L": [{"S": "222222222222"}]}}, {"ControlId": {"S": "CIS.1.6"}}]')
+
+
+def get_fake_dynamodb(**kwargs):
+    dynamodb = FakeDynamoDB(**kwargs)
+    dynamodb.create_table("v1", "ControlId")
+    dynamodb.create_table("v2", "ControlId", "AccountId", indexes={UpdateMember.EXCEPTIONS_ACCOUNT_INDEX: "AccountId"})
+    for item in V1_ITEMS:
+        dynamodb.put("v1", item)
+    return dynamodb
+
+
+def test_convert_exception():
+    items = MigrateExceptions.convert_exception(V1_ITEMS[4])
+    assert items == [{"ControlId": {"S": "CIS.1.5"}, "AccountId": {"S": "222222222222"}, "Disabled": {"BOOL": True}, "Enabled": {"BOOL": True}}]
+    items = MigrateExceptions.convert_exception(V1_ITEMS[0])
+    assert items == [{"ControlId": {"S": "CIS.1.1"}, "AccountId": {"S": "111111111111"}, "Disabled": {"BOOL": True}, "Enabled": {"BOOL": False}, "DisabledReason": {"S": "Some_Reason"}}]
+    assert MigrateExceptions.convert_exception(V1_ITEMS[5]) == []
+
+
+@patch("src.MigrateExceptions.index.time")
+def test_migrate_exceptions(time):
+    dynamodb = get_fake_dynamodb(unprocessed_writes=1)
+    migrated = MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+    assert migrated == 5
+    assert len(dynamodb.tables["v2"]["items"]) == 5
+    time.sleep.assert_called_once_with(MigrateExceptions.RETRY_BASE_DELAY)
+
+    # Migration can be repeated without duplicating items
+    MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+    assert len(dynamodb.tables["v2"]["items"]) == 5
+
+
+def test_migrate_exceptions_deletes_stale_items():
+    dynamodb = get_fake_dynamodb()
+    MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+
+    # Exception removed in v1 after the first migration
+    dynamodb.put("v1", {"ControlId": {"S": "CIS.1.1"}, "Disabled": {"L": []}, "Enabled": {"L": []}})
+    MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+    keys = [(item["ControlId"]["S"], item["AccountId"]["S"]) for item in dynamodb.tables["v2"]["items"]]
+    assert len(keys) == 4
+    assert ("CIS.1.1", "111111111111") not in keys
+
+
+@patch("src.MigrateExceptions.index.time")
+def test_write_batch_retries_exhausted(time):
+    dynamodb = get_fake_dynamodb(unprocessed_writes=MigrateExceptions.MAX_RETRIES + 1)
+    with pytest.raises(MigrateExceptions.MigrationError):
+        MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+    assert time.sleep.call_count == MigrateExceptions.MAX_RETRIES
+    # exponential backoff
+    delays = [call.args[0] for call in time.sleep.call_args_list]
+    assert delays == [MigrateExceptions.RETRY_BASE_DELAY * 2 ** attempt for attempt in range(MigrateExceptions.MAX_RETRIES)]
+    assert dynamodb.tables["v2"]["items"] == []
+
+
+@pytest.mark.parametrize("account_id", ["111111111111", "222222222222", "333333333333"])
+def test_v1_v2_equivalence(account_id):
+    """
+    Exceptions of an account are the same whether read from the v1 or the migrated v2 table
+    """
+    dynamodb = get_fake_dynamodb()
+    MigrateExceptions.migrate_exceptions(dynamodb, "v1", "v2")
+
+    v1_exceptions = GetMembers.convert_exceptions({"Items": MigrateExceptions.scan_table(dynamodb, "v1")})
+    v1 = UpdateMember.get_exceptions({"account": account_id, "exceptions": v1_exceptions})
+    v2_exceptions = UpdateMember.get_account_exceptions(dynamodb, "v2", account_id)
+    v2 = UpdateMember.get_exceptions({"account": account_id, "exceptions": v2_exceptions})
+
+    assert v1["Disabled"] == v2["Disabled"]
+    assert v1["Enabled"] == v2["Enabled"]
+    for control in v2["DisabledReason"]:
+        assert v2["DisabledReason"][control] == v1["DisabledReason"][control]
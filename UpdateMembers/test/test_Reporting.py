@@ -0,0 +1,55 @@
+import gzip
+import json
+import pytest
+import src.Reporting.snapshot as snapshot
+import src.UpdateMember.index as UpdateMember
+from unittest.mock import MagicMock
+
+ROWS_1 = [
+    {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "disabledReason": "SomeReason", "exceptionSource": "Exception"},
+    {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.2", "controlArn": "cis_1_2_arn", "status": "ENABLED", "disabledReason": "", "exceptionSource": "Administrator"},
+]
+ROWS_2 = [
+    {"account": "acc_2", "standard": "standard_1", "controlId": "CIS.1.1", "controlArn": "cis_1_1_arn", "status": "ENABLED", "disabledReason": "", "exceptionSource": "Administrator"},
+]
+
+
+def write(directory, key, data):
+    path = directory / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def test_snapshot_local_store(tmp_path):
+    write(tmp_path, "2022-01-01T00:00:00Z/_SNAPSHOT.json.gz", UpdateMember.write_snapshot(ROWS_1))
+    write(tmp_path, "2022-01-01T00:00:00Z/_MANIFEST.json", json.dumps({"processed": ["acc_1"], "failed": []}).encode())
+    write(tmp_path, "2022-01-02T00:00:00Z/_SNAPSHOT.json.gz", UpdateMember.write_snapshot(ROWS_1 + ROWS_2))
+    write(tmp_path, "2022-01-02T00:00:00Z/_MANIFEST.json", json.dumps({"processed": ["acc_1", "acc_2"], "failed": ["acc_3"]}).encode())
+    # Run still in progress
+    write(tmp_path, "2022-01-03T00:00:00Z/acc_1.json.gz", UpdateMember.write_snapshot(ROWS_1))
+    store = snapshot.LocalSnapshotStore(str(tmp_path))
+
+    run = snapshot.get_latest_run(store)
+    assert run == "2022-01-02T00:00:00Z"
+    assert snapshot.load_manifest(store, run)["failed"] == ["acc_3"]
+    columns = snapshot.load_snapshot(store, run)
+    assert columns["account"] == ["acc_1", "acc_1", "acc_2"]
+    assert snapshot.query_snapshot(columns, controlId="CIS.1.1", status="DISABLED") == [ROWS_1[0]]
+    assert snapshot.query_snapshot(columns, account="acc_2") == ROWS_2
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.load_snapshot(store, "2022-01-03T00:00:00Z")
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.read_snapshot(gzip.compress(b'{"version": 0}'))
+
+
+def test_snapshot_local_store_empty(tmp_path):
+    assert snapshot.get_latest_run(snapshot.LocalSnapshotStore(str(tmp_path))) is None
+
+
+def test_snapshot_s3_store():
+    client = MagicMock()
+    client.get_paginator.return_value.paginate.return_value = [{"CommonPrefixes": [{"Prefix": "run_2/"}, {"Prefix": "run_1/"}]}]
+    client.list_objects_v2.side_effect = lambda Bucket, Prefix, MaxKeys: {"Contents": [{"Key": "run_1/_MANIFEST.json"}]} if Prefix == "run_1/_MANIFEST.json" else {}
+    store = snapshot.S3SnapshotStore("bucket", client)
+    assert snapshot.get_latest_run(store) == "run_1"
@@ -1,9 +1,15 @@
+import gzip
 import json
 import pytest
 import src.UpdateMember.index as UpdateMember
+import src.Reporting.snapshot as snapshot
 from unittest.mock import patch, MagicMock
 import logging
+import threading
+import boto3
 import botocore
+from botocore.config import Config
+from test.fake_dynamodb import FakeDynamoDB
 
 logger = logging.getLogger()
 
@@ -28,8 +34,9 @@ def test_lambda_handler_success(get_enabled_standard_subscriptions, boto3, os):
     """
     event = json.loads('{ "account": "acc_1", "exceptions": { "CIS.1.1": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Some_Reason" }, "CIS.1.2": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.4": { "Disabled": [ "acc_1" ], "Enabled": [], "DisabledReason": "Exception" }, "CIS.1.3": { "Disabled": [], "Enabled": [ "acc_1" ], "DisabledReason": "Exception" }, "CIS.1.5": { "Disabled": [], "Enabled": [], "DisabledReason": "Exception" } } }')
     context = MagicMock(return_value="admin_acc")
-    expected_response_success = {"statusCode": 200, "account": "acc_1"}
-    with patch.object(UpdateMember, "update_standard_subscription", return_value=True):
+    expected_response_success = {"statusCode": 200, "account": "acc_1", "metrics": {"duration": 12.5, "calls": 0, "retries": 0, "throttleWait": 0}}
+    with patch.object(UpdateMember, "update_standard_subscription", return_value=True), patch.object(UpdateMember, "time") as time:
+        time.monotonic.side_effect = [0, 12.5]
         response = UpdateMember.lambda_handler(event, context)
     assert get_enabled_standard_subscriptions.call_count == 3
     assert response == expected_response_success
@@ -48,8 +55,10 @@ def test_lambda_handler_fail(boto3, os):
     error.get.return_value.get.return_value = error_message
     boto3.client = MagicMock(side_effect=botocore.exceptions.ClientError(error, operation))
     context = MagicMock(return_value="admin_acc")
-    expected_response_fail = {"statusCode": 500, "account": "acc_1", "error": "An error occurred (" + error_message + ") when calling the " + operation + " operation: " + error_message}
-    response = UpdateMember.lambda_handler(event, context)
+    expected_response_fail = {"statusCode": 500, "account": "acc_1", "error": "An error occurred (" + error_message + ") when calling the " + operation + " operation: " + error_message, "metrics": {"duration": 1.5, "calls": 0, "retries": 0, "throttleWait": 0}}
+    with patch.object(UpdateMember, "time") as time:
+        time.monotonic.side_effect = [0, 1.5]
+        response = UpdateMember.lambda_handler(event, context)
     assert response == expected_response_fail
 
 
@@ -210,3 +219,452 @@ def test_get_controls():
     expected_response = {"arn": [control]}
     response = UpdateMember.get_controls(enabled_standards, client)
     assert response == expected_response
+
+
+def test_count_call():
+    UpdateMember.call_metrics.update({"calls": 0, "retries": 0, "throttleWait": 0})
+    UpdateMember.count_call(parsed={"ResponseMetadata": {"RetryAttempts": 2}})
+    UpdateMember.count_call(parsed={})
+    assert UpdateMember.call_metrics == {"calls": 2, "retries": 2, "throttleWait": 0}
+
+
+def test_register_metrics():
+    """
+    The time between the first and the last "before-send" handler is the time spent in the client side rate limiter
+    """
+    client = boto3.client("securityhub", region_name="us-east-1", aws_access_key_id="id", aws_secret_access_key="key", config=Config(retries={"mode": "adaptive"}))
+    UpdateMember.register_metrics(client)
+    handlers = list(client.meta.events._emitter._handlers.prefix_search("before-send.securityhub.DescribeStandards"))
+    assert handlers[0] is UpdateMember.start_send
+    assert handlers[-1] is UpdateMember.end_send
+
+    UpdateMember.call_metrics.update({"calls": 0, "retries": 0, "throttleWait": 0})
+    with patch.object(UpdateMember, "time") as time:
+        time.monotonic.side_effect = [1, 3.5]
+        UpdateMember.start_send()
+        UpdateMember.end_send()
+    assert UpdateMember.call_metrics["throttleWait"] == 2.5
+
+
+def test_plan_member():
+    admin_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "DISABLED", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "cis_1_3_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.3"},
+    ]}
+    member_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "cis_1_3_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.3"},
+    ]}
+    exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
+
+    changes = list(UpdateMember.get_control_changes(admin_controls, member_controls, exceptions))
+    plan = UpdateMember.plan_member(changes, "acc_1")
+    assert plan == [
+        {"account": "acc_1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "reason": UpdateMember.REASON_EXCEPTION, "fingerprint": UpdateMember.get_fingerprint(member_controls["standard_1"][0]), "disabledReason": "SomeReason"},
+        {"account": "acc_1", "controlArn": "cis_1_2_arn", "status": "DISABLED", "reason": UpdateMember.REASON_ADMINISTRATOR, "fingerprint": UpdateMember.get_fingerprint(member_controls["standard_1"][1])},
+    ]
+
+
+def test_write_read_plan():
+    plan = [{"account": "acc_1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "reason": "Exception", "fingerprint": "abc", "disabledReason": "SomeReason"}]
+    lines = UpdateMember.write_plan(plan, "acc_1")
+    assert len(lines.splitlines()) == 2
+    assert UpdateMember.read_plan(lines, "acc_1") == plan
+
+    with pytest.raises(UpdateMember.ChangePlanError):
+        UpdateMember.read_plan('{"version": 0}\n', "acc_1")
+    with pytest.raises(UpdateMember.ChangePlanError):
+        UpdateMember.read_plan("", "acc_1")
+    # Plan of another account
+    with pytest.raises(UpdateMember.ChangePlanError):
+        UpdateMember.read_plan(lines, "acc_2")
+    # Truncated plan
+    with pytest.raises(UpdateMember.ChangePlanError):
+        UpdateMember.read_plan(lines.splitlines()[0], "acc_1")
+
+
+@patch("src.UpdateMember.index.update_control_status")
+def test_apply_plan(update_control_status):
+    planned_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "cis_1_3_arn", "ControlStatus": "DISABLED", "DisabledReason": "Reason", "ControlId": "CIS.1.3"},
+    ]}
+    plan = [
+        {"account": "acc_1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "reason": "Exception", "fingerprint": UpdateMember.get_fingerprint(planned_controls["standard_1"][0]), "disabledReason": "SomeReason"},
+        {"account": "acc_1", "controlArn": "cis_1_2_arn", "status": "DISABLED", "reason": "Administrator", "fingerprint": UpdateMember.get_fingerprint(planned_controls["standard_1"][1])},
+        {"account": "acc_1", "controlArn": "cis_1_3_arn", "status": "ENABLED", "reason": "Administrator", "fingerprint": UpdateMember.get_fingerprint(planned_controls["standard_1"][2])},
+        {"account": "acc_1", "controlArn": "cis_1_4_arn", "status": "ENABLED", "reason": "Administrator", "fingerprint": "abc"},
+    ]
+    # CIS.1.2 was disabled after planning and CIS.1.4 does not exist anymore
+    current_controls = {"standard_1": [
+        planned_controls["standard_1"][0],
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "DISABLED", "DisabledReason": "Manual", "ControlId": "CIS.1.2"},
+        planned_controls["standard_1"][2],
+    ]}
+    client = MagicMock()
+
+    applied, failed, stale = UpdateMember.apply_plan(plan, current_controls, client)
+    assert (len(applied), failed, stale) == (2, [], 2)
+    assert applied[0] == (current_controls["standard_1"][0], "DISABLED", "SomeReason", "Exception")
+    assert update_control_status.call_count == 2
+    update_control_status.assert_any_call(current_controls["standard_1"][0], client, "DISABLED", disabled_reason="SomeReason")
+    update_control_status.assert_any_call(current_controls["standard_1"][2], client, "ENABLED", disabled_reason=None)
+
+
+@patch("src.UpdateMember.index.update_control_status")
+def test_apply_plan_fail(update_control_status):
+    member_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.2"},
+    ]}
+    plan = [
+        {"account": "acc_1", "controlArn": control["StandardsControlArn"], "status": "DISABLED", "reason": "Administrator", "fingerprint": UpdateMember.get_fingerprint(control)}
+        for control in member_controls["standard_1"]
+    ]
+    error = botocore.exceptions.ClientError({"Error": {"Code": "ThrottlingException"}}, "UpdateStandardsControl")
+
+    def fail_first_control(member_control, client, status, disabled_reason=None):
+        if member_control["ControlId"] == "CIS.1.1":
+            raise error
+
+    # The first change fails, the second one is applied anyway
+    update_control_status.side_effect = fail_first_control
+
+    applied, failed, stale = UpdateMember.apply_plan(plan, member_controls, MagicMock())
+    assert applied == [(member_controls["standard_1"][1], "DISABLED", None, "Administrator")]
+    assert failed == [(plan[0], str(error))]
+    assert stale == 0
+
+
+@patch("src.UpdateMember.index.store_plan")
+@patch("src.UpdateMember.index.get_standard_controls")
+@patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_plan(boto3, os, get_enabled_standard_subscriptions, get_standard_controls, store_plan):
+    """
+    Plan mode stores the change plan and does not change the member account
+    """
+    event = {"account": "acc_1", "mode": "plan", "plan": "plan_1", "exceptions": {}}
+    get_enabled_standard_subscriptions.return_value = {"StandardsSubscriptions": [{"StandardsArn": "standard_1", "StandardsSubscriptionArn": "subscription_1"}]}
+    get_standard_controls.side_effect = lambda standard, client: [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "DISABLED" if client is UpdateMember.administrator_security_hub_client else "ENABLED", "ControlId": "CIS.1.1"}
+    ]
+    context = MagicMock(return_value="admin_acc")
+    with patch.object(UpdateMember, "update_standard_subscription") as update_standard_subscription, patch.object(UpdateMember, "update_control_status") as update_control_status:
+        response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 200
+    assert response["changes"] == 1
+    update_standard_subscription.assert_not_called()
+    update_control_status.assert_not_called()
+    plan = UpdateMember.read_plan(store_plan.call_args.args[0], "acc_1")
+    assert plan[0]["controlArn"] == "cis_1_1_arn"
+    assert store_plan.call_args.args[1:] == ("plan_1", "acc_1")
+
+
+@patch("src.UpdateMember.index.store_plan")
+@patch("src.UpdateMember.index.get_standard_controls")
+@patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_exceptions_v2(boto3, os, get_enabled_standard_subscriptions, get_standard_controls, store_plan):
+    """
+    With the v2 schema the exceptions of the account are queried from the v2 table instead of read from the event
+    """
+    os.environ = {"ExceptionsSchema": "v2", "DynamoDBV2": "v2", "MemberRole": "arn:aws:iam::<accountId>:role/role"}
+    dynamodb = FakeDynamoDB()
+    dynamodb.create_table("v2", "ControlId", "AccountId", indexes={UpdateMember.EXCEPTIONS_ACCOUNT_INDEX: "AccountId"})
+    dynamodb.put("v2", {"ControlId": {"S": "CIS.1.1"}, "AccountId": {"S": "acc_1"}, "Disabled": {"BOOL": True}, "Enabled": {"BOOL": False}, "DisabledReason": {"S": "Some_Reason"}})
+    dynamodb.put("v2", {"ControlId": {"S": "CIS.1.2"}, "AccountId": {"S": "acc_2"}, "Disabled": {"BOOL": True}, "Enabled": {"BOOL": False}})
+    event = {"account": "acc_1", "mode": "plan", "plan": "plan_1"}
+    get_enabled_standard_subscriptions.return_value = {"StandardsSubscriptions": [{"StandardsArn": "standard_1", "StandardsSubscriptionArn": "subscription_1"}]}
+    get_standard_controls.return_value = [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.2"},
+    ]
+    context = MagicMock(return_value="admin_acc")
+    with patch.object(UpdateMember, "dynamodb_client", dynamodb):
+        response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 200
+    # Only the exception of acc_1 applies
+    plan = UpdateMember.read_plan(store_plan.call_args.args[0], "acc_1")
+    assert len(plan) == 1
+    assert plan[0]["controlArn"] == "cis_1_1_arn"
+    assert plan[0]["status"] == "DISABLED"
+    assert plan[0]["disabledReason"] == "Some_Reason"
+    assert plan[0]["reason"] == UpdateMember.REASON_EXCEPTION
+
+
+def test_get_snapshot_rows():
+    member_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "DISABLED", "DisabledReason": "Old_Reason", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "cis_1_3_arn", "ControlStatus": "DISABLED", "DisabledReason": "Some_Reason", "ControlId": "CIS.1.3"},
+    ]}
+    exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
+    changes = [
+        (member_controls["standard_1"][0], "DISABLED", "SomeReason", "Exception"),
+        (member_controls["standard_1"][1], "ENABLED", None, "Administrator"),
+    ]
+    rows = UpdateMember.get_snapshot_rows("acc_1", member_controls, exceptions, changes)
+    assert rows == [
+        {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "disabledReason": "SomeReason", "exceptionSource": "Exception"},
+        {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.2", "controlArn": "cis_1_2_arn", "status": "ENABLED", "disabledReason": "", "exceptionSource": "Administrator"},
+        {"account": "acc_1", "standard": "standard_1", "controlId": "CIS.1.3", "controlArn": "cis_1_3_arn", "status": "DISABLED", "disabledReason": "Some_Reason", "exceptionSource": "Administrator"},
+    ]
+
+
+@patch("src.UpdateMember.index.update_control_status")
+def test_plan_from_snapshot(update_control_status):
+    """
+    A plan created from the stored control state snapshot equals the plan created from the member's Security Hub
+    """
+    admin_controls = {"standard_1": [
+        {"StandardsControlArn": "admin_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "admin_1_2_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "admin_1_3_arn", "ControlStatus": "DISABLED", "DisabledReason": "Admin_Reason", "ControlId": "CIS.1.3"},
+    ]}
+    member_controls = {"standard_1": [
+        {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"},
+        {"StandardsControlArn": "cis_1_2_arn", "ControlStatus": "DISABLED", "DisabledReason": "Old_Reason", "ControlId": "CIS.1.2"},
+        {"StandardsControlArn": "cis_1_3_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.3"},
+    ]}
+    exceptions = {"Disabled": ["CIS.1.1"], "Enabled": [], "DisabledReason": {"CIS.1.1": "SomeReason"}}
+    rows = UpdateMember.get_snapshot_rows("acc_1", member_controls, exceptions, [])
+    rows += UpdateMember.get_snapshot_rows("acc_2", {"standard_1": [dict(member_controls["standard_1"][0], StandardsControlArn="acc_2_arn")]}, exceptions, [])
+    columns = snapshot.read_snapshot(UpdateMember.write_snapshot(rows))
+
+    assert UpdateMember.get_snapshot_controls(columns, "acc_1") == member_controls
+    plan = UpdateMember.plan_from_snapshot(columns, "acc_1", admin_controls, exceptions)
+    assert plan == UpdateMember.plan_member(list(UpdateMember.get_control_changes(admin_controls, member_controls, exceptions)), "acc_1")
+    assert [change["controlArn"] for change in plan] == ["cis_1_1_arn", "cis_1_2_arn", "cis_1_3_arn"]
+
+    # The plan applies to the live member controls without stale changes
+    applied, failed, stale = UpdateMember.apply_plan(UpdateMember.read_plan(UpdateMember.write_plan(plan, "acc_1"), "acc_1"), member_controls, MagicMock())
+    assert (len(applied), failed, stale) == (3, [], 0)
+
+
+@patch("src.UpdateMember.index.update_control_status")
+def test_reconcile_standards(update_control_status):
+    """
+    Each standard enabled in the member account is reconciled separately. Errors are collected per standard.
+    """
+    administrator_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "standard_1", "StandardsSubscriptionArn": "admin_subscription_1"},
+        {"StandardsArn": "standard_2", "StandardsSubscriptionArn": "admin_subscription_2"},
+    ]}
+    member_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "standard_1", "StandardsSubscriptionArn": "member_subscription_1"},
+        {"StandardsArn": "standard_2", "StandardsSubscriptionArn": "member_subscription_2"},
+        {"StandardsArn": "standard_3", "StandardsSubscriptionArn": "member_subscription_3"},
+    ]}
+    controls = {
+        "admin_subscription_1": [{"StandardsControlArn": "admin_1_1_arn", "ControlStatus": "DISABLED", "ControlId": "CIS.1.1"}],
+        "member_subscription_1": [{"StandardsControlArn": "member_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"}],
+        "member_subscription_3": [{"StandardsControlArn": "member_3_1_arn", "ControlStatus": "ENABLED", "ControlId": "PCI.1"}],
+    }
+
+    def describe_standards_controls(StandardsSubscriptionArn):
+        if StandardsSubscriptionArn not in controls:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied", "Message": "Denied"}}, "DescribeStandardsControls")
+        return {"Controls": controls[StandardsSubscriptionArn]}
+
+    client = MagicMock()
+    client.describe_standards_controls.side_effect = describe_standards_controls
+    exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": {}}
+
+    results, errors = UpdateMember.reconcile_standards(administrator_enabled_standards, member_enabled_standards, client, client, exceptions)
+    assert list(errors) == ["standard_2"]
+    assert results["standard_1"]["changes"] == [(controls["member_subscription_1"][0], "DISABLED", None, UpdateMember.REASON_ADMINISTRATOR)]
+    assert results["standard_3"]["memberControls"] == {"standard_3": controls["member_subscription_3"]}
+    assert results["standard_3"]["changes"] == []
+    update_control_status.assert_called_once_with(controls["member_subscription_1"][0], client, "DISABLED")
+
+    update_control_status.reset_mock()
+    results, errors = UpdateMember.reconcile_standards(administrator_enabled_standards, member_enabled_standards, client, client, exceptions, write=False)
+    assert len(results["standard_1"]["changes"]) == 1
+    update_control_status.assert_not_called()
+
+
+@patch("src.UpdateMember.index.reconcile_standards")
+@patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_standard_error(boto3, os, get_enabled_standard_subscriptions, reconcile_standards):
+    event = {"account": "acc_1", "exceptions": {}}
+    reconcile_standards.return_value = ({}, {"standard_2": "SomeError"})
+    context = MagicMock(return_value="admin_acc")
+    with patch.object(UpdateMember, "update_standard_subscription", return_value=False):
+        response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 500
+    assert response["error"] == "standard_2: SomeError"
+
+
+@pytest.mark.parametrize("event", [
+    {"account": "acc_1", "mode": "preview", "exceptions": {}},
+    {"account": "acc_1", "mode": "plan", "exceptions": {}},
+    {"account": "acc_1", "mode": "apply", "plan": "", "exceptions": {}},
+])
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_invalid_mode(boto3, os, event):
+    """
+    Unknown modes and plan/apply without plan name are rejected before the member account is accessed
+    """
+    context = MagicMock(return_value="admin_acc")
+    with patch.object(UpdateMember, "sts_client") as sts_client, patch.object(UpdateMember, "update_control_status") as update_control_status:
+        response = UpdateMember.lambda_handler(event, context)
+        sts_client.assume_role.assert_not_called()
+    assert response["statusCode"] == 500
+    assert "mode" in response["error"].lower()
+    update_control_status.assert_not_called()
+
+
+@pytest.mark.parametrize("serialized_plan, expected_status, expected_changes", [
+    (None, 200, 0),
+    ('{"version": 2}\n', 500, None),
+    ('{"version": 1}\nnot json\n', 500, None),
+    ('{"version": 1}\n{"account": "acc_1"}\n', 500, None),
+    ('{"version": 1, "account": "acc_2", "changes": 0}\n', 500, None),
+])
+@patch("src.UpdateMember.index.load_plan")
+@patch("src.UpdateMember.index.get_controls")
+@patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_apply(boto3, os, get_enabled_standard_subscriptions, get_controls, load_plan, serialized_plan, expected_status, expected_changes):
+    """
+    A missing plan means no planned changes, an invalid plan fails only this account
+    """
+    event = {"account": "acc_1", "mode": "apply", "plan": "plan_1", "exceptions": {}}
+    get_controls.return_value = {}
+    load_plan.return_value = serialized_plan
+    context = MagicMock(return_value="admin_acc")
+    response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == expected_status
+    if expected_changes is not None:
+        assert response["changes"] == expected_changes
+    load_plan.assert_called_once_with("plan_1", "acc_1")
+
+
+@patch("src.UpdateMember.index.os")
+def test_load_plan_missing(os):
+    os.environ = {"ChangePlans": "bucket"}
+    client = MagicMock()
+    client.get_object.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+    with patch.object(UpdateMember, "s3_client", client):
+        assert UpdateMember.load_plan("plan_1", "acc_1") is None
+        client.get_object.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+        with pytest.raises(botocore.exceptions.ClientError):
+            UpdateMember.load_plan("plan_1", "acc_1")
+
+
+@patch("src.UpdateMember.index.os")
+def test_export_snapshot(os):
+    """
+    Snapshot export failures are logged and do not fail the account
+    """
+    os.environ = {"ControlSnapshots": "bucket"}
+    member_controls = {"standard_1": [{"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"}]}
+    exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": {}}
+    client = MagicMock()
+    with patch.object(UpdateMember, "s3_client", client):
+        UpdateMember.export_snapshot("acc_1", member_controls, exceptions, [], "run_1")
+        assert client.put_object.call_args.kwargs["Key"] == "run_1/acc_1.json.gz"
+        rows = json.loads(gzip.decompress(client.put_object.call_args.kwargs["Body"]))
+        assert rows["columns"]["controlId"] == ["CIS.1.1"]
+
+        client.put_object.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+        UpdateMember.export_snapshot("acc_1", member_controls, exceptions, [], "run_1")
+
+
+@patch("src.UpdateMember.index.export_snapshot")
+@patch("src.UpdateMember.index.update_control_status")
+@patch("src.UpdateMember.index.load_plan")
+@patch("src.UpdateMember.index.get_controls")
+@patch("src.UpdateMember.index.get_enabled_standard_subscriptions")
+@patch("src.UpdateMember.index.os")
+@patch("src.UpdateMember.index.boto3")
+def test_lambda_handler_apply_snapshot(boto3, os, get_enabled_standard_subscriptions, get_controls, load_plan, update_control_status, export_snapshot):
+    """
+    Apply mode exports the control states after applying the plan
+    """
+    member_control = {"StandardsControlArn": "cis_1_1_arn", "ControlStatus": "ENABLED", "ControlId": "CIS.1.1"}
+    get_controls.return_value = {"standard_1": [member_control]}
+    plan = [{"account": "acc_1", "controlArn": "cis_1_1_arn", "status": "DISABLED", "reason": "Administrator", "fingerprint": UpdateMember.get_fingerprint(member_control)}]
+    load_plan.return_value = UpdateMember.write_plan(plan, "acc_1")
+    event = {"account": "acc_1", "mode": "apply", "plan": "plan_1", "run": "run_1", "exceptions": {}}
+    context = MagicMock(return_value="admin_acc")
+    response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 200
+    assert response["changes"] == 1
+    account_id, member_controls, exceptions, changes, run = export_snapshot.call_args.args
+    assert (account_id, run) == ("acc_1", "run_1")
+    assert changes == [(member_control, "DISABLED", None, "Administrator")]
+
+    # Exceptions are loaded before the plan is applied. Failing to load them only skips the snapshot.
+    export_snapshot.reset_mock()
+    update_control_status.reset_mock()
+    error = botocore.exceptions.ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "Query")
+    with patch.object(UpdateMember, "load_exceptions", side_effect=error):
+        response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 200
+    assert response["changes"] == 1
+    update_control_status.assert_called_once()
+    export_snapshot.assert_not_called()
+
+    # Failed changes are reported, the snapshot contains only the applied changes
+    export_snapshot.reset_mock()
+    update_control_status.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "ThrottlingException"}}, "UpdateStandardsControl")
+    response = UpdateMember.lambda_handler(event, context)
+    assert response["statusCode"] == 500
+    assert response["changes"] == 0
+    assert response["failed"] == ["cis_1_1_arn"]
+    assert response["error"].startswith("1 of 1 changes failed: ")
+    assert export_snapshot.call_args.args[3] == []
+
+
+@patch("src.UpdateMember.index.update_control_status")
+def test_reconcile_standards_update_subscriptions(update_control_status):
+    """
+    Standards enabled in both accounts are reconciled while standard subscriptions are updated.
+    Only the standard being enabled waits for the update, the standard being disabled is skipped.
+    """
+    administrator_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "standard_1", "StandardsSubscriptionArn": "admin_subscription_1"},
+        {"StandardsArn": "standard_2", "StandardsSubscriptionArn": "admin_subscription_2"},
+    ]}
+    member_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "standard_1", "StandardsSubscriptionArn": "member_subscription_1"},
+        {"StandardsArn": "standard_3", "StandardsSubscriptionArn": "member_subscription_3"},
+    ]}
+    updated_member_enabled_standards = {"StandardsSubscriptions": [
+        {"StandardsArn": "standard_1", "StandardsSubscriptionArn": "member_subscription_1"},
+        {"StandardsArn": "standard_2", "StandardsSubscriptionArn": "member_subscription_2"},
+    ]}
+    standard_1_reconciled = threading.Event()
+    fetched = []
+
+    def describe_standards_controls(StandardsSubscriptionArn):
+        fetched.append(StandardsSubscriptionArn)
+        if StandardsSubscriptionArn == "member_subscription_1":
+            standard_1_reconciled.set()
+        return {"Controls": []}
+
+    def update_subscriptions():
+        # Blocks until standard_1 is reconciled in parallel
+        assert standard_1_reconciled.wait(timeout=5)
+        assert "member_subscription_2" not in fetched
+        return updated_member_enabled_standards
+
+    client = MagicMock()
+    client.describe_standards_controls.side_effect = describe_standards_controls
+    exceptions = {"Disabled": [], "Enabled": [], "DisabledReason": {}}
+
+    results, errors = UpdateMember.reconcile_standards(administrator_enabled_standards, member_enabled_standards, client, client, exceptions, update_subscriptions=update_subscriptions)
+    assert errors == {}
+    assert sorted(results) == ["standard_1", "standard_2"]
+    assert "member_subscription_3" not in fetched